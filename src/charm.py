@@ -6,16 +6,21 @@
 # Load modules from lib directory
 import json
 import logging
+import subprocess
 
-from charmtools import apt
+from charmtools import apt, pgbench
 from charmtools import postgres as pg
-from charmtools import tools
+from charmtools import slowlog, tools, walsizing
 from ops.charm import CharmBase
 from ops.framework import StoredState
-from ops.model import ActiveStatus, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 
 import setuppath  # noqa:F401
 
+BENCHMARK_DEFAULT_PARAMS = {'scale': 10, 'clients': 10, 'threads': 2, 'duration': 60}
+BENCHMARK_HISTORY_SIZE = 10
+WAL_TUNING_MODES = ('off', 'recommend', 'auto')
+
 
 class PostgresqlCharm(CharmBase):
     """Class reprisenting this Operator charm."""
@@ -27,11 +32,16 @@ class PostgresqlCharm(CharmBase):
         super().__init__(*args)
         # -- standard hook observation
         self.framework.observe(self.on.install, self.on_install)
+        self.framework.observe(self.on.upgrade_charm, self.on_upgrade_charm)
         self.framework.observe(self.on.start, self.on_start)
         self.framework.observe(self.on.config_changed, self.on_config_changed)
+        self.framework.observe(self.on.update_status, self.on_update_status)
         self.framework.observe(self.on.db_relation_changed, self.on_db_relation_changed)
         self.framework.observe(self.on.db_relation_joined, self.on_db_relation_changed)
         self.framework.observe(self.on.db_relation_departed, self.on_db_relation_departed)
+        # -- actions observation
+        self.framework.observe(self.on.analyze_slow_queries_action, self.on_analyze_slow_queries_action)
+        self.framework.observe(self.on.benchmark_action, self.on_benchmark_action)
         # -- initialize states --
         self.state.set_default(
             installed=False,
@@ -40,7 +50,14 @@ class PostgresqlCharm(CharmBase):
             databases={},
             rel_db_map={},
             unit_ip_map={},
+            database_pool={},
+            database_pool_template='',
             pg_listen_port=5432,
+            pg_settings={},
+            wal_settings={},
+            wal_stats_sample='',
+            pg_hba_rules=[],
+            benchmark_history=[],
             open_ports=[5432],
         )
         self.pg_service = pg.PGService(
@@ -55,6 +72,13 @@ class PostgresqlCharm(CharmBase):
         logging.info('Install of software complete')
         self.state.installed = True
 
+    def on_upgrade_charm(self, event):
+        """Handle upgrade charm."""
+        if not self.state.installed:
+            return
+        # replace pg_hba rules written by previous charm revisions, e.g. 'host all all 0.0.0.0/0 md5'
+        self._update_pg_hba(force=True)
+
     def on_config_changed(self, event):
         """Handle config changed."""
         if not self.state.installed:
@@ -68,13 +92,174 @@ class PostgresqlCharm(CharmBase):
             logging.info(f'Stopping for configuration, event handle: {event.handle}')
         # Configure the software
         logging.info('Configuring')
+        self._reset_wal_tuning_state()
         if self.model.config['port'] != self.state.pg_listen_port:
-            self.pg_service.configure_postgresql_server(self.model.config['port'])
+            pg_settings = self._get_pg_settings()
+            self.pg_service.configure_postgresql_server(self.model.config['port'], pg_settings)
             self.pg_service.restart_postgresql_server()
+            self.state.pg_settings = pg_settings
             self._update_listen_port()
             self._update_db_relations()
+        else:
+            self._apply_pg_settings()
         self.state.configured = True
 
+    def _reset_wal_tuning_state(self):
+        # don't re-apply settings computed from stale samples once wal_tuning is switched back to auto
+        wal_tuning = self.model.config['wal_tuning']
+        if wal_tuning != 'auto':
+            self.state.wal_settings = {}
+        if wal_tuning not in ('recommend', 'auto'):
+            self.state.wal_stats_sample = ''
+
+    def _apply_pg_settings(self):
+        # settings rendered into juju.conf don't require server restart
+        pg_settings = self._get_pg_settings()
+        if pg_settings != dict(self.state.pg_settings):
+            self.pg_service.configure_postgresql_server(self.model.config['port'], pg_settings)
+            self.pg_service.reload_postgresql_server()
+            self.state.pg_settings = pg_settings
+
+    def _get_pg_settings(self):
+        settings = dict(self.state.wal_settings) if self.model.config['wal_tuning'] == 'auto' else {}
+        log_min_duration_statement = self.model.config['log_min_duration_statement']
+        if log_min_duration_statement >= 0:
+            settings['log_min_duration_statement'] = str(log_min_duration_statement)
+        auto_explain_log_min_duration = self.model.config['auto_explain_log_min_duration']
+        if auto_explain_log_min_duration >= 0:
+            settings['session_preload_libraries'] = "'auto_explain'"
+            settings['auto_explain.log_min_duration'] = str(auto_explain_log_min_duration)
+        return settings
+
+    def on_update_status(self, event):
+        """Handle update status."""
+        self._tune_wal_settings()
+        if not self.model.unit.is_leader():
+            logging.debug(f'Unit {self.model.unit.name} is not leader, skip refilling database pool')
+            return
+        if not self.state.started:
+            logging.debug('PostgreSQL is not started yet, skip refilling database pool')
+            return
+        try:
+            self._refill_database_pool()
+        except subprocess.CalledProcessError as e:
+            logging.error(f'Refilling database pool failed: {e}')
+            self.unit.status = BlockedStatus('Refilling database pool failed, see juju debug-log')
+        else:
+            if isinstance(self.unit.status, BlockedStatus):
+                self.unit.status = ActiveStatus(f'PostgreSQL {self.pg_service.get_version()} running')
+
+    def _tune_wal_settings(self):
+        wal_tuning = self.model.config['wal_tuning']
+        if wal_tuning not in WAL_TUNING_MODES:
+            logging.warning(f'Unknown wal_tuning mode: {wal_tuning}, expected one of: {", ".join(WAL_TUNING_MODES)}')
+            return
+        if wal_tuning == 'off' or not self.state.started:
+            return
+        floor = self.model.config['wal_tuning_max_wal_size_floor']
+        ceiling = self.model.config['wal_tuning_max_wal_size_ceiling']
+        if floor > ceiling:
+            logging.warning(f'wal_tuning_max_wal_size_floor {floor} exceeds ceiling {ceiling}, skip WAL tuning')
+            return
+
+        try:
+            sample = self.pg_service.get_wal_stats()
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logging.warning(f'Sampling WAL statistics failed, skip WAL tuning: {e}')
+            return
+        previous_sample = self.state.wal_stats_sample
+        self.state.wal_stats_sample = json.dumps(sample)
+        if not previous_sample:
+            return
+        wal_settings = walsizing.recommend_settings(json.loads(previous_sample), sample, floor, ceiling)
+        if not wal_settings:
+            return
+
+        if wal_tuning == 'recommend':
+            version = self.pg_service.get_version()
+            changed_settings = walsizing.get_changed_settings(wal_settings, sample)
+            if not changed_settings:
+                # drop previous recommendation once it's applied or no longer needed, keep other statuses
+                if isinstance(self.unit.status, ActiveStatus):
+                    self.unit.status = ActiveStatus(f'PostgreSQL {version} running')
+                return
+            recommendation = ', '.join(f'{name}={value}' for name, value in sorted(changed_settings.items()))
+            logging.info(f'Recommended WAL settings: {recommendation}')
+            self.unit.status = ActiveStatus(f'PostgreSQL {version} running, recommended: {recommendation}')
+        else:
+            self.state.wal_settings = wal_settings
+            self._apply_pg_settings()
+
+    def _refill_database_pool(self):
+        template = self.model.config['database_pool_template']
+        if template != self.state.database_pool_template:
+            # spare databases created from previous template are no longer valid
+            self._drop_pool_databases(list(self.state.database_pool))
+            self.state.database_pool_template = template
+
+        pool_size = self.model.config['database_pool_size']
+        pool_databases = list(self.state.database_pool)
+        if len(pool_databases) > pool_size:
+            self._drop_pool_databases(pool_databases[pool_size:])
+        elif len(pool_databases) < pool_size:
+            logging.info(f'Refilling database pool with {pool_size - len(pool_databases)} databases')
+            credentials = self.pg_service.create_pg_pool_databases(pool_size - len(pool_databases), template or None)
+            for database, database_credentials in credentials.items():
+                self.state.database_pool[database] = json.dumps(database_credentials)
+
+    def _drop_pool_databases(self, databases):
+        for database in databases:
+            db_data = json.loads(self.state.database_pool[database])
+            self.pg_service.drop_pg_database(database)
+            self.pg_service.drop_pg_user(db_data['user'])
+            # forget pool database only once it's dropped, so a failed drop can be retried
+            self.state.database_pool.pop(database)
+
+    def on_analyze_slow_queries_action(self, event):
+        """Summarize slow statements found in PostgreSQL log files."""
+        try:
+            since, until = (
+                slowlog.parse_timestamp(event.params[param]) if event.params.get(param) else None
+                for param in ('since', 'until')
+            )
+        except ValueError as e:
+            event.fail(f'Invalid time window: {e}')
+            return
+
+        lines = slowlog.iter_log_lines(self.pg_service.get_log_file_paths())
+        summary = slowlog.summarize_slow_statements(lines, since, until)
+        event.set_results(
+            {
+                'fingerprints': len(summary),
+                'statements': json.dumps(summary[: event.params['limit']]),
+            }
+        )
+
+    def on_benchmark_action(self, event):
+        """Run pgbench load test and compare result with the previous run."""
+        if pg.PGBENCH_DATABASE in self.state.databases:
+            # pgbench drops its scratch database, never touch database provided to db relation
+            event.fail(f'Database {pg.PGBENCH_DATABASE} is used by db relation, benchmark would drop it')
+            return
+        params = {param: event.params.get(param, default) for param, default in BENCHMARK_DEFAULT_PARAMS.items()}
+        try:
+            result = self.pg_service.run_pgbench(**params)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            event.fail(f'Benchmark failed: {e}')
+            return
+
+        result = {'port': self.state.pg_listen_port, **params, **result}
+        results = {key.replace('_', '-'): value for key, value in result.items()}
+        if self.state.benchmark_history:
+            previous_result = json.loads(self.state.benchmark_history[-1])
+            changes = pgbench.compare_results(result, previous_result)
+            results.update({f'{key}-change-percent'.replace('_', '-'): value for key, value in changes.items()})
+        event.set_results(results)
+
+        self.state.benchmark_history.append(json.dumps(result))
+        while len(self.state.benchmark_history) > BENCHMARK_HISTORY_SIZE:
+            self.state.benchmark_history.pop(0)
+
     def _update_listen_port(self):
         port = self.model.config['port']
         self.state.pg_listen_port = port
@@ -120,7 +305,12 @@ class PostgresqlCharm(CharmBase):
             return
         if event.unit not in event.relation.data:
             return
-        self._update_db_relation(event.relation, event.unit)
+        if self._provision_pending_databases():
+            # publish credentials for every relation waiting for newly created databases
+            self._publish_db_relations()
+        else:
+            self._update_db_relation(event.relation, event.unit)
+        self._update_pg_hba()
 
     def on_db_relation_departed(self, event):
         if not self.model.unit.is_leader():
@@ -145,6 +335,7 @@ class PostgresqlCharm(CharmBase):
                 self.pg_service.drop_pg_database(database)
                 self.pg_service.drop_pg_user(db_data['user'])
                 self.state.rel_db_map.pop(event.relation.id, None)
+        self._update_pg_hba()
 
     def _update_db_relations(self):
         if not self.model.unit.is_leader():
@@ -152,11 +343,111 @@ class PostgresqlCharm(CharmBase):
             return
 
         self._update_port_in_state_databases()
+        self._provision_pending_databases()
+        self._publish_db_relations()
+        self._update_pg_hba()
+
+    def _update_pg_hba(self, force=False):
+        pg_hba_rules = self._get_pg_hba_rules()
+        if not force and pg_hba_rules == list(self.state.pg_hba_rules):
+            logging.debug('pg_hba rules not changed, skip reloading server')
+            return
+        self.pg_service.update_pg_hba_conf(pg_hba_rules)
+        self.pg_service.reload_postgresql_server()
+        self.state.pg_hba_rules = pg_hba_rules
+
+    def _get_pg_hba_rules(self):
+        """Build pg_hba rules allowing database users to connect from related units' subnets."""
+        subnets = {}
+        for db_relation in self.model.relations['db']:
+            database = self.state.rel_db_map.get(db_relation.id)
+            if database not in self.state.databases:
+                continue
+            user = json.loads(self.state.databases[database])['user']
+            for unit in db_relation.units:
+                unit_ips = self.state.unit_ip_map.get(unit.name)
+                if unit_ips:
+                    subnets.setdefault((database, user), []).extend(unit_ips.split(','))
+        return [
+            [database, user, subnet]
+            for (database, user), db_subnets in sorted(subnets.items())
+            for subnet in tools.collapse_subnets(db_subnets)
+        ]
+
+    def _publish_db_relations(self):
         for db_relation in self.model.relations['db']:
             logging.debug(f'UPDATE RELATION: {db_relation}')
             for unit in db_relation.units:
                 self._update_db_relation(db_relation, unit)
 
+    def _provision_pending_databases(self):
+        """Create all requested but not yet provisioned databases at once."""
+        pending_databases = self._get_pending_databases()
+        if not pending_databases:
+            return False
+        logging.debug(f'PROVISIONING DATABASES: {pending_databases}')
+        claimed_credentials = self._claim_pool_databases(pending_databases)
+        for database, database_credentials in claimed_credentials.items():
+            self.state.databases[database] = json.dumps(database_credentials)
+
+        missing_databases = [database for database in pending_databases if database not in claimed_credentials]
+        if not missing_databases:
+            return True
+        template = self.model.config['database_pool_template'] or None
+        try:
+            credentials = self.pg_service.create_pg_databases_and_users(missing_databases, template)
+        except subprocess.CalledProcessError as e:
+            if not claimed_credentials:
+                raise
+            # renamed pool databases are already committed, keep them in state and publish them
+            logging.error(f'Creating databases {missing_databases} failed: {e}')
+            self.unit.status = BlockedStatus('Creating databases failed, see juju debug-log')
+            return True
+        for database, database_credentials in credentials.items():
+            self.state.databases[database] = json.dumps(database_credentials)
+        return True
+
+    def _claim_pool_databases(self, databases):
+        """Hand out spare databases from the pool by renaming them."""
+        renames = dict(zip(list(self.state.database_pool), databases))
+        if not renames:
+            return {}
+        logging.debug(f'CLAIMING POOL DATABASES: {renames}')
+        self.pg_service.rename_pg_databases(renames)
+
+        port = self.model.config['port']
+        credentials = {}
+        for pool_database, database in renames.items():
+            db_data = json.loads(self.state.database_pool.pop(pool_database))
+            db_data.update(
+                {
+                    'port': str(port),
+                    'database': database,
+                    'master': pg.build_connection_string(
+                        db_data['host'], port, database, db_data['user'], db_data['password']
+                    ),
+                }
+            )
+            credentials[database] = db_data
+        return credentials
+
+    def _get_pending_databases(self):
+        pending_databases = []
+        for db_relation in self.model.relations['db']:
+            for unit in db_relation.units:
+                database = db_relation.data[unit].get('database')
+                if database and database not in self.state.databases and database not in pending_databases:
+                    pending_databases.append(database)
+        if not pending_databases:
+            return []
+
+        # databases not created by the charm (e.g. postgres) are never handed out to db relations
+        existing_databases = self.pg_service.get_pg_databases()
+        for database in pending_databases:
+            if database in existing_databases:
+                logging.error(f'Database {database} already exists and is not managed by the charm, skip provisioning')
+        return [database for database in pending_databases if database not in existing_databases]
+
     def _update_port_in_state_databases(self):
         port = self.model.config['port']
         for database, db_data in self.state.databases.items():
@@ -179,13 +470,18 @@ class PostgresqlCharm(CharmBase):
             logging.debug('No database name provided, skip further event processing')
             return
 
+        # databases are provisioned in batches by _provision_pending_databases before relations are updated
         if database not in self.state.databases:
-            database_credentials = self.pg_service.create_pg_database_and_user(database)
-            self.state.databases[database] = json.dumps(database_credentials)
-        else:
-            database_credentials = json.loads(self.state.databases[database])
+            logging.debug(f'Database {database} is not provisioned, skip further event processing')
+            return
+        database_credentials = json.loads(self.state.databases[database])
 
-        self.state.unit_ip_map[unit.name] = ','.join(tools.incoming_addresses(data))
+        unit_ips = ','.join(tools.incoming_addresses(data))
+        if self._is_db_relation_up_to_date(relation, unit, database, database_credentials, unit_ips):
+            logging.debug(f'Relation {relation.id} already provides {database} to {unit.name}, skip update')
+            return
+
+        self.state.unit_ip_map[unit.name] = unit_ips
         self.state.rel_db_map[relation.id] = database
 
         self._set_pg_properties(relation, database_credentials)
@@ -194,6 +490,17 @@ class PostgresqlCharm(CharmBase):
         logging.debug(f'DATABASE CHANGED: {dict(self.state.rel_db_map)}')
         logging.debug(f'DATABASE CHANGED: {dict(relation.data[self.model.unit])}')
 
+    def _is_db_relation_up_to_date(self, relation, unit, database, database_credentials, unit_ips):
+        data, published_data = relation.data[unit], relation.data[self.model.unit]
+        return (
+            self.state.rel_db_map.get(relation.id) == database
+            and self.state.unit_ip_map.get(unit.name) == unit_ips
+            and published_data.get('master') == database_credentials['master']
+            and unit.name in published_data.get('allowed-units', '').split(',')
+            and published_data.get('roles') == data.get('roles', '')
+            and published_data.get('extensions') == data.get('extensions', '')
+        )
+
     def _set_pg_properties(self, relation, database_credentials):
         logging.debug(database_credentials)
         for k, v in database_credentials.items():
@@ -0,0 +1,47 @@
+import re
+
+from charmtools import tools
+
+# PostgreSQL < 14 reports 'excluding connections establishing', newer versions 'without initial connection time'
+TPS_PATTERN = re.compile(r'^tps = (?P<tps>\d+(?:\.\d+)?) \((?:excluding|without)', re.MULTILINE)
+LATENCY_AVERAGE_PATTERN = re.compile(r'^latency average = (?P<latency>\d+(?:\.\d+)?) ms', re.MULTILINE)
+PERCENTILES = (50, 95, 99)
+
+
+def parse_pgbench_output(output):
+    tps = TPS_PATTERN.search(output)
+    latency = LATENCY_AVERAGE_PATTERN.search(output)
+    if not tps or not latency:
+        raise ValueError(f'Unexpected pgbench output: {output}')
+    return {'tps': float(tps.group('tps')), 'latency_average_ms': float(latency.group('latency'))}
+
+
+def iter_transaction_latencies(paths):
+    """Yield transaction latencies in milliseconds from pgbench per-transaction log files.
+
+    Each log line starts with: client_id transaction_no time_us script_no ...
+    Skipped and failed transactions are ignored.
+    """
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2 and fields[2].isdigit():
+                    yield int(fields[2]) / 1000
+
+
+def summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {f'latency_p{p}_ms': round(tools.percentile(latencies, p), 3) for p in PERCENTILES}
+
+
+def compare_results(result, previous_result):
+    """Return relative change (in percent) of each metric compared with previous result."""
+    changes = {}
+    for metric, value in result.items():
+        previous_value = previous_result.get(metric)
+        if isinstance(value, float) and previous_value:
+            changes[metric] = round((value - previous_value) / previous_value * 100, 2)
+    return changes
@@ -1,16 +1,42 @@
 from functools import partial
+import json
 from pathlib import Path
 import random
 import re
+import shutil
 import string
+import subprocess
+import tempfile
 from urllib.parse import quote
 
-from charmtools import service, tools
+from charmtools import pgbench, service, tools
 
 POSTGRESQL_VERSION_PATTERN = re.compile(r'PostgreSQL (\d+\.\d+) ')
 POSTGRESQL_CONF_BASE_DIR = Path('/etc/postgresql')
+POSTGRESQL_LOG_DIR = Path('/var/log/postgresql')
 POSTGRESQL_CONF_JUJU_START_MARK = '# JUJU SECTION'
 POSTGRESQL_CONF_JUJU_END_MARK = '# JUJU END SECTION'
+PGBENCH_DATABASE = 'juju_pgbench'
+WAL_STATS_QUERY = (
+    'SELECT checkpoints_timed, checkpoints_req, maxwritten_clean, '
+    "pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0'), extract(epoch FROM now()), "
+    "(SELECT setting FROM pg_settings WHERE name = 'max_wal_size'), "
+    "(SELECT setting FROM pg_settings WHERE name = 'checkpoint_timeout'), "
+    "(SELECT setting FROM pg_settings WHERE name = 'bgwriter_lru_maxpages'), "
+    "(SELECT setting FROM pg_settings WHERE name = 'checkpoint_completion_target') "
+    'FROM pg_stat_bgwriter'
+)
+WAL_STATS_FIELDS = (
+    'checkpoints_timed',
+    'checkpoints_req',
+    'maxwritten_clean',
+    'wal_bytes',
+    'timestamp',
+    'max_wal_size',
+    'checkpoint_timeout',
+    'bgwriter_lru_maxpages',
+    'checkpoint_completion_target',
+)
 
 
 class PGService:
@@ -29,29 +55,69 @@ class PGService:
     def set_port(self, port):
         self._port = str(port)
 
-    def create_pg_database_and_user(self, database, username=None):
-        username = username or f'juju_{_get_random_string(16)}'
-        password = _get_random_string(16)
-
-        self._psql(f'CREATE DATABASE "{database}"')
-        self._psql(f"CREATE USER \"{username}\" WITH ENCRYPTED PASSWORD '{password}'")
-        self._psql(f'GRANT ALL PRIVILEGES ON DATABASE "{database}" TO "{username}"')
+    def create_pg_databases_and_users(self, databases, template=None):
+        credentials = {}
+        for database in databases:
+            credentials[database] = (f'juju_{_get_random_string(16)}', _get_random_string(16))
+        if not credentials:
+            return {}
+
+        users_query = '; '.join(
+            f"CREATE USER \"{username}\" WITH ENCRYPTED PASSWORD '{password}'; "
+            f'GRANT ALL PRIVILEGES ON DATABASE "{database}" TO "{username}"'
+            for database, (username, password) in credentials.items()
+        )
+        # CREATE DATABASE can't run inside a transaction block, users and grants are created in a single one
+        template_clause = f' TEMPLATE "{template}"' if template else ''
+        existing_databases = self.get_pg_databases()
+        try:
+            self._psql(*[f'CREATE DATABASE "{database}"{template_clause}' for database in credentials], users_query)
+        except subprocess.CalledProcessError:
+            # each CREATE DATABASE commits on its own, drop databases created before the failure
+            for database in (self.get_pg_databases() - existing_databases) & set(credentials):
+                self.drop_pg_database(database)
+            raise
 
         return {
-            'host': self._host,
-            'port': self._port,
-            'database': database,
-            'user': username,
-            'password': password,
-            'master': build_connection_string(self._host, self._port, database, username, password),
+            database: self._build_database_credentials(database, username, password)
+            for database, (username, password) in credentials.items()
         }
 
+    def create_pg_pool_databases(self, count, template=None):
+        databases = [f'juju_pool_{_get_random_string(16).lower()}' for _ in range(count)]
+        return self.create_pg_databases_and_users(databases, template)
+
+    def rename_pg_databases(self, databases):
+        if databases:
+            self._psql('; '.join(f'ALTER DATABASE "{old}" RENAME TO "{new}"' for old, new in databases.items()))
+
+    def get_pg_databases(self):
+        return set(json.loads(self._psql_value('SELECT json_agg(datname) FROM pg_database')))
+
     def drop_pg_database(self, database):
         self._psql(f'DROP DATABASE "{database}"')
 
     def drop_pg_user(self, user):
         self._psql(f'DROP USER "{user}"')
 
+    def run_pgbench(self, scale, clients, threads, duration):
+        # scratch database may be left behind by an interrupted run
+        self._psql(f'DROP DATABASE IF EXISTS "{PGBENCH_DATABASE}"')
+        self._psql(f'CREATE DATABASE "{PGBENCH_DATABASE}"')
+        try:
+            with tempfile.TemporaryDirectory() as log_dir:
+                # per-transaction logs are written by pgbench running as postgres user
+                shutil.chown(log_dir, user=self._user)
+                self._pgbench('-i', '-q', '-s', scale, PGBENCH_DATABASE)
+                log_args = ['-l', '--log-prefix', f'{log_dir}/pgbench_log']
+                output = self._pgbench('-c', clients, '-j', threads, '-T', duration, *log_args, PGBENCH_DATABASE)
+                result = pgbench.parse_pgbench_output(output.decode('utf-8'))
+                latencies = pgbench.iter_transaction_latencies(Path(log_dir).glob('pgbench_log*'))
+                result.update(pgbench.summarize_latencies(latencies))
+        finally:
+            self.drop_pg_database(PGBENCH_DATABASE)
+        return result
+
     def get_version(self):
         if not self._version:
             resp = self._psql('SELECT version()').decode('utf-8')
@@ -60,18 +126,60 @@ class PGService:
                 self._version = m.group(1)
         return self._version
 
-    def configure_postgresql_server(self, port):
-        self._update_postgresql_conf(port)
-        self._update_pg_hba_conf()
+    def get_wal_stats(self):
+        # max_wal_size is reported in MB, checkpoint_timeout in seconds
+        values = self._psql_row(WAL_STATS_QUERY)
+        return {field: float(value) for field, value in zip(WAL_STATS_FIELDS, values)}
+
+    def configure_postgresql_server(self, port, settings=None):
+        self._update_postgresql_conf(port, settings or {})
+
+    def update_pg_hba_conf(self, rules):
+        self._update_pg_hba_conf([f'host "{database}" "{user}" {subnet} md5\n' for database, user, subnet in rules])
 
     @staticmethod
     def restart_postgresql_server():
         service.restart('postgresql')
 
-    def _psql(self, query):
-        return tools.run('sudo', '-u', self._user, 'psql', '-p', self._port, '-c', f'{query}')
+    @staticmethod
+    def reload_postgresql_server():
+        service.reload('postgresql')
+
+    def get_log_file_paths(self):
+        major_version = self.get_version().split('.')[0]
+        # oldest rotated log files first
+        return sorted(
+            POSTGRESQL_LOG_DIR.glob(f'postgresql-{major_version}-main.log*'),
+            key=lambda path: (_get_log_rotation_index(path), path.name),
+            reverse=True,
+        )
+
+    def _psql(self, *queries):
+        # abort on the first failed command, otherwise psql exit status reflects only the last one
+        args = [arg for query in queries for arg in ('-c', f'{query}')]
+        return tools.run('sudo', '-u', self._user, 'psql', '-p', self._port, '-v', 'ON_ERROR_STOP=1', *args)
+
+    def _psql_row(self, query):
+        return self._psql_value(query).split('|')
+
+    def _psql_value(self, query):
+        resp = tools.run('sudo', '-u', self._user, 'psql', '-p', self._port, '-A', '-t', '-c', f'{query}')
+        return resp.decode('utf-8').strip()
+
+    def _pgbench(self, *args):
+        return tools.run('sudo', '-u', self._user, 'pgbench', '-p', self._port, *args)
+
+    def _build_database_credentials(self, database, username, password):
+        return {
+            'host': self._host,
+            'port': self._port,
+            'database': database,
+            'user': username,
+            'password': password,
+            'master': build_connection_string(self._host, self._port, database, username, password),
+        }
 
-    def _update_postgresql_conf(self, port):
+    def _update_postgresql_conf(self, port, settings):
         config_path = self._get_pg_conf_file_path('postgresql.conf')
         juju_config_path = self._get_pg_etc_dir() / 'conf.d' / 'juju.conf'
         pg_config_lines = _extract_pg_conf_original_content(config_path)
@@ -81,15 +189,16 @@ class PGService:
             f.writelines(pg_config_lines)
 
         with juju_config_path.open('w') as f:
-            _write_juju_config_section(f, ["listen_addresses = '*'\n", f'port = {port}\n'])
+            settings_lines = [f'{name} = {value}\n' for name, value in sorted(settings.items())]
+            _write_juju_config_section(f, ["listen_addresses = '*'\n", f'port = {port}\n', *settings_lines])
 
-    def _update_pg_hba_conf(self):
+    def _update_pg_hba_conf(self, rules_lines):
         config_path = self._get_pg_conf_file_path('pg_hba.conf')
         pg_config_lines = _extract_pg_conf_original_content(config_path)
 
         with config_path.open('w') as f:
             f.writelines(pg_config_lines)
-            _write_juju_config_section(f, ['host all all 0.0.0.0/0 md5\n'])
+            _write_juju_config_section(f, rules_lines)
 
     def _get_pg_conf_file_path(self, name):
         return self._get_pg_etc_dir() / name
@@ -106,6 +215,12 @@ def _get_random_string(length):
     return ''.join(random.choice(letters) for _ in range(length))
 
 
+def _get_log_rotation_index(path):
+    # postgresql-10-main.log -> 0, postgresql-10-main.log.1 -> 1, postgresql-10-main.log.2.gz -> 2
+    suffix = path.name.split('.log', 1)[1].strip('.').split('.')[0]
+    return int(suffix) if suffix.isdigit() else 0
+
+
 def build_connection_string(host, port, database, username, password):
     q = partial(quote, safe='')
     return f'dbname={q(database)} host={q(host)} password={q(password)} port={port} user={q(username)}'
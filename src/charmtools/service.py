@@ -10,3 +10,4 @@ def _service(action, service):
 start = partial(_service, 'start')
 stop = partial(_service, 'stop')
 restart = partial(_service, 'restart')
+reload = partial(_service, 'reload')
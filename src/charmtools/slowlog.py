@@ -0,0 +1,95 @@
+from datetime import datetime
+import gzip
+import hashlib
+import re
+
+from charmtools import tools
+
+# matches default Ubuntu log_line_prefix '%m [%p] %q%u@%d '
+LOG_LINE_PATTERN = re.compile(r'^(?P<timestamp>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:\.\d+)? \S+ \[\d+\]')
+DURATION_PATTERN = re.compile(
+    r'LOG:\s+duration: (?P<duration>\d+(?:\.\d+)?) ms\s+(?:statement|execute [^:]*): (?P<statement>.*)$'
+)
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+PERCENTILES = (50, 95, 99)
+
+_NORMALIZE_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def parse_timestamp(value):
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def normalize_statement(statement):
+    normalized = statement.strip().rstrip(';').lower()
+    for pattern, replacement in _NORMALIZE_PATTERNS:
+        normalized = pattern.sub(replacement, normalized)
+    return normalized.strip()
+
+
+def get_fingerprint(normalized_statement):
+    return hashlib.md5(normalized_statement.encode('utf-8')).hexdigest()[:16]
+
+
+def iter_log_lines(paths):
+    for path in paths:
+        open_file = gzip.open if path.suffix == '.gz' else open
+        with open_file(path, 'rt', errors='replace') as f:
+            yield from f
+
+
+def iter_slow_statements(lines):
+    """Yield (timestamp, duration_ms, statement) tuples of logged slow statements.
+
+    Multi-line statements are continued in following lines starting with a tab.
+    """
+    entry = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('\t'):
+            if entry:
+                entry[2].append(line.strip())
+            continue
+        if entry:
+            yield entry[0], entry[1], ' '.join(entry[2])
+            entry = None
+        m = LOG_LINE_PATTERN.match(line)
+        if not m:
+            continue
+        d = DURATION_PATTERN.search(line, m.end())
+        if d:
+            entry = (parse_timestamp(m.group('timestamp')), float(d.group('duration')), [d.group('statement')])
+    if entry:
+        yield entry[0], entry[1], ' '.join(entry[2])
+
+
+def summarize_slow_statements(lines, since=None, until=None):
+    durations, statements = {}, {}
+    for timestamp, duration, statement in iter_slow_statements(lines):
+        if (since and timestamp < since) or (until and timestamp > until):
+            continue
+        normalized = normalize_statement(statement)
+        fingerprint = get_fingerprint(normalized)
+        durations.setdefault(fingerprint, []).append(duration)
+        statements.setdefault(fingerprint, normalized)
+
+    summary = []
+    for fingerprint, fingerprint_durations in durations.items():
+        fingerprint_durations.sort()
+        summary.append(
+            {
+                'fingerprint': fingerprint,
+                'statement': statements[fingerprint],
+                'count': len(fingerprint_durations),
+                'total_ms': round(sum(fingerprint_durations), 3),
+                'max_ms': fingerprint_durations[-1],
+                **{f'p{p}_ms': tools.percentile(fingerprint_durations, p) for p in PERCENTILES},
+            }
+        )
+    return sorted(summary, key=lambda item: item['total_ms'], reverse=True)
@@ -1,5 +1,6 @@
 from functools import partial
 import ipaddress
+import math
 import subprocess
 
 
@@ -53,3 +54,28 @@ def _addr_to_range(addr):
         return str(ipaddress.ip_network(addr, strict=False))
     except ValueError:
         return addr
+
+
+def collapse_subnets(subnets):
+    """Merge overlapping and adjacent subnets.
+
+    IPv4 and IPv6 networks are collapsed separately, hostnames are passed
+    through unchanged. Returns a list with stable ordering.
+    """
+    networks = {4: [], 6: []}
+    hostnames = set()
+    for subnet in subnets:
+        try:
+            network = ipaddress.ip_network(subnet, strict=False)
+        except ValueError:
+            hostnames.add(subnet)
+            continue
+        networks[network.version].append(network)
+    collapsed = [str(network) for version in (4, 6) for network in ipaddress.collapse_addresses(networks[version])]
+    return collapsed + sorted(hostnames)
+
+
+def percentile(sorted_values, percent):
+    """Return percentile of sorted values using nearest-rank method."""
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
@@ -0,0 +1,52 @@
+import math
+
+CHECKPOINT_COMPLETION_TARGET = 0.9
+MAX_WAL_SIZE_STEP_MB = 64
+# ignore max_wal_size changes smaller than this fraction to avoid reloading server on every sample
+MAX_WAL_SIZE_CHANGE_THRESHOLD = 0.25
+BGWRITER_LRU_MAXPAGES_LIMIT = 1000
+MB = 1024 * 1024
+COUNTERS = ('checkpoints_timed', 'checkpoints_req', 'maxwritten_clean', 'wal_bytes', 'timestamp')
+
+
+def recommend_settings(previous_sample, sample, max_wal_size_floor, max_wal_size_ceiling):
+    """Recommend checkpoint, WAL and bgwriter settings from two pg_stat_bgwriter/WAL samples.
+
+    max_wal_size is sized to hold WAL written during one checkpoint_timeout, with
+    room for spreading checkpoints, and kept within given limits (in MB). Returns
+    an empty dict if samples can't be compared, e.g. after statistics reset.
+    """
+    delta = {counter: sample[counter] - previous_sample[counter] for counter in COUNTERS}
+    if any(value < 0 for value in delta.values()) or delta['timestamp'] <= 0:
+        return {}
+
+    wal_mb_per_checkpoint = delta['wal_bytes'] / MB / delta['timestamp'] * sample['checkpoint_timeout']
+    max_wal_size = wal_mb_per_checkpoint * (2 + CHECKPOINT_COMPLETION_TARGET)
+    if delta['checkpoints_req'] > delta['checkpoints_timed']:
+        # WAL bursts force checkpoints before checkpoint_timeout, grow at least twice
+        max_wal_size = max(max_wal_size, sample['max_wal_size'] * 2)
+    max_wal_size = math.ceil(max_wal_size / MAX_WAL_SIZE_STEP_MB) * MAX_WAL_SIZE_STEP_MB
+    max_wal_size = min(max(max_wal_size, max_wal_size_floor), max_wal_size_ceiling)
+    if abs(max_wal_size - sample['max_wal_size']) <= sample['max_wal_size'] * MAX_WAL_SIZE_CHANGE_THRESHOLD:
+        max_wal_size = int(sample['max_wal_size'])
+
+    bgwriter_lru_maxpages = int(sample['bgwriter_lru_maxpages'])
+    if delta['maxwritten_clean'] > 0:
+        # bgwriter stopped cleaning because it wrote too many buffers in a round
+        bgwriter_lru_maxpages = min(bgwriter_lru_maxpages * 2, BGWRITER_LRU_MAXPAGES_LIMIT)
+
+    return {
+        'max_wal_size': f'{max_wal_size}MB',
+        'checkpoint_completion_target': str(CHECKPOINT_COMPLETION_TARGET),
+        'bgwriter_lru_maxpages': str(bgwriter_lru_maxpages),
+    }
+
+
+def get_changed_settings(settings, sample):
+    """Return settings which differ from live values reported in sample."""
+    live_settings = {
+        'max_wal_size': f'{int(sample["max_wal_size"])}MB',
+        'checkpoint_completion_target': str(sample['checkpoint_completion_target']),
+        'bgwriter_lru_maxpages': str(int(sample['bgwriter_lru_maxpages'])),
+    }
+    return {name: value for name, value in settings.items() if live_settings.get(name) != value}
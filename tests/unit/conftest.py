@@ -93,6 +93,21 @@ def pg_main_dir():
     postgres.POSTGRESQL_CONF_BASE_DIR = old_value
 
 
+@pytest.fixture
+def previous_sample():
+    return {
+        'checkpoints_timed': 10.0,
+        'checkpoints_req': 0.0,
+        'maxwritten_clean': 0.0,
+        'wal_bytes': 0.0,
+        'timestamp': 1601971200.0,
+        'max_wal_size': 1024.0,
+        'checkpoint_timeout': 300.0,
+        'bgwriter_lru_maxpages': 100.0,
+        'checkpoint_completion_target': 0.5,
+    }
+
+
 @pytest.fixture
 def harness(charm_class, charm_dir, model_network):
     harness = Harness(charm_class)
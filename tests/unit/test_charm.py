@@ -1,5 +1,8 @@
+import json
+import subprocess
 from unittest import mock
 
+from ops.model import ActiveStatus
 import pytest
 
 from .base import create_db_relation
@@ -10,6 +13,13 @@ def mock_pg_version(fake_process, pg_version_resp):
     _register_query(fake_process, 'SELECT version()', stdout=pg_version_resp)
 
 
+@pytest.fixture(autouse=True)
+def pg_databases():
+    databases = {'postgres', 'template0', 'template1'}
+    with mock.patch('charmtools.postgres.PGService.get_pg_databases', return_value=databases) as get_pg_databases:
+        yield get_pg_databases
+
+
 @pytest.fixture
 def random_string():
     random_str = 'HH88buR4'
@@ -19,10 +29,8 @@ def random_string():
 
 def assert_pg_configs(pg_main_dir, port):
     postgresql_conf = _read_content(pg_main_dir / 'postgresql.conf')
-    pg_hba_conf = _read_content(pg_main_dir / 'pg_hba.conf')
     juju_conf = _read_content(pg_main_dir / 'conf.d' / 'juju.conf')
     assert 'port = ' not in postgresql_conf
-    assert 'host all all 0.0.0.0/0 md5' in pg_hba_conf
     assert "listen_addresses = '*'" in juju_conf
     assert f'port = {port}' in juju_conf
 
@@ -49,6 +57,7 @@ def test_create_charm(harness):
     assert harness.charm.state.databases == {}
     assert harness.charm.state.rel_db_map == {}
     assert harness.charm.state.unit_ip_map == {}
+    assert harness.charm.state.database_pool == {}
     assert harness.charm.state.pg_listen_port == 5432
     assert harness.charm.state.open_ports == [5432]
 
@@ -61,13 +70,29 @@ def test_install(harness, fake_process, postgresql_package_installed):
     assert fake_process.call_count(postgresql_package_installed) == 1
 
 
+def test_upgrade_charm_rewrites_pg_hba_rules(harness, fake_process, pg_main_dir):
+    pg_hba_path = pg_main_dir / 'pg_hba.conf'
+    with pg_hba_path.open('a') as f:
+        f.write('# JUJU SECTION\nhost all all 0.0.0.0/0 md5\n# JUJU END SECTION\n')
+    reload_call = _register_reload(fake_process)
+    harness.begin()
+    harness.charm.state.installed = True
+
+    harness.charm.on.upgrade_charm.emit()
+
+    assert 'host all all 0.0.0.0/0 md5' not in _read_content(pg_hba_path)
+    assert harness.charm.state.pg_hba_rules == []
+    assert fake_process.call_count(reload_call) == 1
+
+
 def test_config_changed(
     harness, db_relation, unit, pg_unit_ip, db_rel_request, pg_version_resp, fake_process, random_string, pg_main_dir
 ):
     curr_port, new_port = 5432, 5555
     database = db_rel_request['database']
     _register_query(fake_process, 'SELECT version()', stdout=pg_version_resp, port=str(new_port))
-    _mock_pg_database_and_user_psql_calls(fake_process, database, random_string, new_port)
+    _mock_pg_databases_and_users_psql_call(fake_process, {database: random_string}, new_port)
+    reload_call = _register_reload(fake_process)
     harness.begin()
     harness.charm.state.installed = True
 
@@ -81,6 +106,8 @@ def test_config_changed(
         assert harness.charm.state.configured
         assert not harness.charm.state.started
         assert_pg_configs(pg_main_dir, new_port)
+        pg_hba_conf = _read_content(pg_main_dir / 'pg_hba.conf')
+        assert f'host "{database}" "juju_{random_string}" {db_rel_request["egress-subnets"]} md5' in pg_hba_conf
         rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
         assert_db_relation_data(
             rel_data, database, [unit.name], [db_rel_request['egress-subnets']], random_string, pg_unit_ip, new_port
@@ -91,6 +118,212 @@ def test_config_changed(
     curr_port, new_port = _run_test(curr_port, new_port)
     # change port to default: 5555 -> 5432
     _run_test(curr_port, new_port)
+    # pg_hba rules didn't change with the second port change
+    assert fake_process.call_count(reload_call) == 1
+
+
+def test_config_changed_slow_query_logging(harness, fake_process, pg_main_dir):
+    reload_call = _register_reload(fake_process)
+    harness.begin()
+    harness.charm.state.installed = True
+
+    harness.update_config({'log_min_duration_statement': 250, 'auto_explain_log_min_duration': 1000})
+
+    juju_conf = _read_content(pg_main_dir / 'conf.d' / 'juju.conf')
+    assert 'log_min_duration_statement = 250' in juju_conf
+    assert "session_preload_libraries = 'auto_explain'" in juju_conf
+    assert 'auto_explain.log_min_duration = 1000' in juju_conf
+    assert fake_process.call_count(reload_call) == 1
+
+    # unchanged settings don't reload server
+    harness.update_config({'log_min_duration_statement': 250})
+
+    assert fake_process.call_count(reload_call) == 1
+
+
+def test_analyze_slow_queries_action(harness, tmp_path):
+    log_lines = [
+        '2020-10-06 10:00:00.123 UTC [1234] juju_x@db LOG:  duration: 12.500 ms  statement: SELECT * FROM t WHERE id=5',
+        '2020-10-06 10:05:00.123 UTC [1234] juju_x@db LOG:  duration: 30.000 ms  statement: SELECT * FROM t',
+        '\tWHERE id = 7',
+        '2020-10-06 10:10:00.123 UTC [1234] juju_x@db LOG:  connection received: host=10.216.12.86',
+    ]
+    (tmp_path / 'postgresql-10-main.log').write_text('\n'.join(log_lines) + '\n')
+    event = mock.Mock(params={'since': '2020-10-06 10:01:00', 'limit': 20})
+    harness.begin()
+
+    with mock.patch('charmtools.postgres.POSTGRESQL_LOG_DIR', tmp_path):
+        harness.charm.on_analyze_slow_queries_action(event)
+
+    results = event.set_results.call_args[0][0]
+    assert results['fingerprints'] == 1
+    [statement] = json.loads(results['statements'])
+    assert statement['statement'] == 'select * from t where id = ?'
+    assert statement['count'] == 1
+    assert statement['p99_ms'] == 30.0
+
+
+def test_analyze_slow_queries_action_invalid_time_window(harness):
+    event = mock.Mock(params={'since': 'yesterday'})
+    harness.begin()
+
+    harness.charm.on_analyze_slow_queries_action(event)
+
+    event.fail.assert_called_once()
+    event.set_results.assert_not_called()
+
+
+def test_benchmark_action(harness):
+    pgbench_results = [
+        {'tps': 1000.0, 'latency_average_ms': 10.0, 'latency_p99_ms': 20.0},
+        {'tps': 1250.0, 'latency_average_ms': 8.0, 'latency_p99_ms': 15.0},
+    ]
+    harness.begin()
+
+    with mock.patch.object(harness.charm.pg_service, 'run_pgbench', side_effect=pgbench_results) as run_pgbench:
+        first_event = mock.Mock(params={'scale': 1, 'duration': 10})
+        harness.charm.on_benchmark_action(first_event)
+        second_event = mock.Mock(params={'scale': 1, 'duration': 10})
+        harness.charm.on_benchmark_action(second_event)
+
+    run_pgbench.assert_called_with(scale=1, clients=10, threads=2, duration=10)
+    first_results = first_event.set_results.call_args[0][0]
+    assert first_results['tps'] == 1000.0
+    assert 'tps-change-percent' not in first_results
+    second_results = second_event.set_results.call_args[0][0]
+    assert second_results['tps'] == 1250.0
+    assert second_results['latency-p99-ms'] == 15.0
+    assert second_results['tps-change-percent'] == 25.0
+    assert second_results['latency-average-ms-change-percent'] == -20.0
+    assert len(harness.charm.state.benchmark_history) == 2
+
+
+def test_benchmark_action_database_used_by_relation(harness):
+    event = mock.Mock(params={})
+    harness.begin()
+    harness.charm.state.databases['juju_pgbench'] = json.dumps({'user': 'juju_HH88buR4'})
+
+    with mock.patch.object(harness.charm.pg_service, 'run_pgbench') as run_pgbench:
+        harness.charm.on_benchmark_action(event)
+
+    run_pgbench.assert_not_called()
+    event.fail.assert_called_once()
+
+
+def test_benchmark_action_failed(harness):
+    event = mock.Mock(params={})
+    harness.begin()
+    error = subprocess.CalledProcessError(1, 'pgbench')
+
+    with mock.patch.object(harness.charm.pg_service, 'run_pgbench', side_effect=error):
+        harness.charm.on_benchmark_action(event)
+
+    event.fail.assert_called_once()
+    assert len(harness.charm.state.benchmark_history) == 0
+
+
+def test_update_status_applies_wal_settings(harness, fake_process, pg_main_dir, previous_sample):
+    reload_call = _register_reload(fake_process)
+    # WAL written in bursts forces checkpoints
+    sample = dict(previous_sample, checkpoints_req=5.0, wal_bytes=3000.0 * 1024 * 1024, timestamp=1601971500.0)
+    harness.update_config({'wal_tuning': 'auto'})
+    harness.begin()
+    harness.charm.state.started = True
+
+    with mock.patch.object(harness.charm.pg_service, 'get_wal_stats', side_effect=[previous_sample, sample]):
+        # first sample is only stored
+        harness.charm.on.update_status.emit()
+        assert fake_process.call_count(reload_call) == 0
+
+        harness.charm.on.update_status.emit()
+
+    juju_conf = _read_content(pg_main_dir / 'conf.d' / 'juju.conf')
+    assert 'max_wal_size = 8704MB' in juju_conf
+    assert 'checkpoint_completion_target = 0.9' in juju_conf
+    assert 'bgwriter_lru_maxpages = 100' in juju_conf
+    assert fake_process.call_count(reload_call) == 1
+
+
+def test_update_status_recommends_wal_settings(harness, fake_process, pg_version, previous_sample):
+    reload_call = _register_reload(fake_process)
+    sample = dict(previous_sample, maxwritten_clean=2.0, timestamp=1601971500.0)
+    harness.update_config({'wal_tuning': 'recommend'})
+    harness.begin()
+    harness.charm.state.started = True
+    harness.charm.state.wal_stats_sample = json.dumps(previous_sample)
+
+    with mock.patch.object(harness.charm.pg_service, 'get_wal_stats', return_value=sample):
+        harness.charm.on.update_status.emit()
+
+    # max_wal_size doesn't change, so it's not recommended
+    assert harness.charm.unit.status.message == (
+        f'PostgreSQL {pg_version} running, recommended: bgwriter_lru_maxpages=200, checkpoint_completion_target=0.9'
+    )
+    assert harness.charm.state.wal_settings == {}
+    assert fake_process.call_count(reload_call) == 0
+
+
+def test_update_status_recommends_nothing_for_current_wal_settings(harness, pg_version, previous_sample):
+    previous_sample['checkpoint_completion_target'] = 0.9
+    sample = dict(previous_sample, timestamp=1601971500.0)
+    harness.update_config({'wal_tuning': 'recommend'})
+    harness.begin()
+    harness.charm.state.started = True
+    harness.charm.state.wal_stats_sample = json.dumps(previous_sample)
+    # recommendation reported by previous update-status has been applied since
+    harness.charm.unit.status = ActiveStatus(
+        f'PostgreSQL {pg_version} running, recommended: checkpoint_completion_target=0.9'
+    )
+
+    with mock.patch.object(harness.charm.pg_service, 'get_wal_stats', return_value=sample):
+        harness.charm.on.update_status.emit()
+
+    assert harness.charm.unit.status == ActiveStatus(f'PostgreSQL {pg_version} running')
+
+
+def test_update_status_wal_stats_sampling_failed(harness, fake_process):
+    pool_database = 'juju_pool_aa11'
+    harness.update_config({'wal_tuning': 'auto', 'database_pool_size': 1})
+    harness.begin()
+    harness.charm.state.started = True
+    create_db_call = _mock_pg_databases_and_users_psql_call(fake_process, {pool_database: 'Bb22'})
+    error = subprocess.CalledProcessError(2, 'psql')
+
+    with mock.patch.object(harness.charm.pg_service, 'get_wal_stats', side_effect=error), mock.patch(
+        'charmtools.postgres._get_random_string', side_effect=['Aa11', 'Bb22', 'Bb22']
+    ):
+        harness.charm.on.update_status.emit()
+
+    # failed sampling doesn't stop database pool refill
+    assert harness.charm.state.wal_stats_sample == ''
+    assert fake_process.call_count(create_db_call) == 1
+    assert pool_database in harness.charm.state.database_pool
+
+
+def test_update_status_wal_tuning_invalid_limits(harness):
+    harness.update_config(
+        {'wal_tuning': 'auto', 'wal_tuning_max_wal_size_floor': 4096, 'wal_tuning_max_wal_size_ceiling': 1024}
+    )
+    harness.begin()
+    harness.charm.state.started = True
+
+    with mock.patch.object(harness.charm.pg_service, 'get_wal_stats') as get_wal_stats:
+        harness.charm.on.update_status.emit()
+
+    get_wal_stats.assert_not_called()
+
+
+def test_config_changed_wal_tuning_off_resets_state(harness, previous_sample):
+    harness.update_config({'wal_tuning': 'auto'})
+    harness.begin()
+    harness.charm.state.installed = True
+    harness.charm.state.wal_settings = {'max_wal_size': '8704MB'}
+    harness.charm.state.wal_stats_sample = json.dumps(previous_sample)
+
+    harness.update_config({'wal_tuning': 'off'})
+
+    assert harness.charm.state.wal_settings == {}
+    assert harness.charm.state.wal_stats_sample == ''
 
 
 def test_start(harness, pg_version):
@@ -117,12 +350,13 @@ def test_db_relation_joined(harness, app, unit, db_rel_request):
     assert dict(rel_data) == {}
 
 
-def test_db_relation_changed(harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string):
+def test_db_relation_changed(
+    harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string, pg_main_dir
+):
     database = db_rel_request['database']
     egress = db_rel_request['egress-subnets']
-    create_db_call, create_user_call, grant_user_call = _mock_pg_database_and_user_psql_calls(
-        fake_process, database, random_string
-    )
+    create_db_call = _mock_pg_databases_and_users_psql_call(fake_process, {database: random_string})
+    reload_call = _register_reload(fake_process)
     harness.begin()
 
     harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
@@ -131,8 +365,6 @@ def test_db_relation_changed(harness, db_relation, app, unit, pg_unit_ip, db_rel
     assert_db_relation_data(rel_data, database, [unit.name], [egress], random_string, pg_unit_ip)
     assert database in harness.charm.state.databases
     assert fake_process.call_count(create_db_call) == 1
-    assert fake_process.call_count(create_user_call) == 1
-    assert fake_process.call_count(grant_user_call) == 1
 
     # add another unit to existing db relation
     app_unit_1 = f'{app.name}/1'
@@ -149,8 +381,241 @@ def test_db_relation_changed(harness, db_relation, app, unit, pg_unit_ip, db_rel
     )
     # assert there was no new SQL queries to create db/user
     assert fake_process.call_count(create_db_call) == 1
-    assert fake_process.call_count(create_user_call) == 1
-    assert fake_process.call_count(grant_user_call) == 1
+    # both units share the same subnet, pg_hba rules are not changed
+    assert fake_process.call_count(reload_call) == 1
+
+
+def test_db_relation_changed_republishes_roles(
+    harness, db_relation, app, unit, db_rel_request, fake_process, random_string, pg_main_dir
+):
+    database = db_rel_request['database']
+    create_db_call = _mock_pg_databases_and_users_psql_call(fake_process, {database: random_string})
+    _register_reload(fake_process)
+    harness.begin()
+
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
+    assert rel_data['roles'] == ''
+
+    # consumer requests roles after its database has been provisioned
+    harness.update_relation_data(db_relation.id, unit.name, {'roles': 'reader,writer', 'extensions': 'hstore'})
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
+    assert rel_data['roles'] == 'reader,writer'
+    assert rel_data['extensions'] == 'hstore'
+    assert fake_process.call_count(create_db_call) == 1
+
+
+def test_db_relation_changed_provisions_pending_databases(
+    harness, app, unit, pg_unit_ip, db_rel_request, fake_process, pg_main_dir
+):
+    other_app_name = 'other'
+    other_unit_name = f'{other_app_name}/0'
+    other_db_rel_request = dict(db_rel_request, database='other_dev_db')
+    relation = create_db_relation(harness, app.name, unit.name, db_rel_request)
+    other_relation = create_db_relation(harness, other_app_name, other_unit_name, other_db_rel_request)
+    other_unit = harness.model.get_unit(other_unit_name)
+    random_strings = ['HH88buR4', 'Ky27cwP9']
+    create_db_call = _mock_pg_databases_and_users_psql_call(
+        fake_process,
+        {db_rel_request['database']: random_strings[0], other_db_rel_request['database']: random_strings[1]},
+    )
+    _register_reload(fake_process)
+    harness.begin()
+
+    # each database gets random username and password
+    side_effect = [random_str for random_str in random_strings for _ in range(2)]
+    with mock.patch('charmtools.postgres._get_random_string', side_effect=side_effect):
+        harness.charm.on.db_relation_changed.emit(relation, app, unit)
+
+    # both databases are created by the first event
+    assert fake_process.call_count(create_db_call) == 1
+    for rel, request, random_string, rel_unit in [
+        (relation, db_rel_request, random_strings[0], unit),
+        (other_relation, other_db_rel_request, random_strings[1], other_unit),
+    ]:
+        rel_data = harness.model.get_relation(rel.name, rel.id).data[harness.model.unit]
+        assert_db_relation_data(
+            rel_data, request['database'], [rel_unit.name], [request['egress-subnets']], random_string, pg_unit_ip
+        )
+
+    # follow-up event for already provisioned relation is a no-op
+    harness.charm.on.db_relation_changed.emit(other_relation, other_unit.app, other_unit)
+
+    assert fake_process.call_count(create_db_call) == 1
+
+
+def test_update_status_refills_database_pool(harness, fake_process):
+    pool_databases = ['juju_pool_aa11', 'juju_pool_bb22']
+    # pool database names first, then username and password for each database
+    random_strings = ['Aa11', 'Bb22', 'Cc33', 'Cc33', 'Dd44', 'Dd44']
+    create_db_call = _mock_pg_databases_and_users_psql_call(
+        fake_process, {pool_databases[0]: 'Cc33', pool_databases[1]: 'Dd44'}, template='tpl_db'
+    )
+    harness.update_config({'database_pool_size': 2, 'database_pool_template': 'tpl_db'})
+    harness.begin()
+    harness.charm.state.started = True
+
+    with mock.patch('charmtools.postgres._get_random_string', side_effect=random_strings):
+        harness.charm.on.update_status.emit()
+
+    assert fake_process.call_count(create_db_call) == 1
+    assert sorted(harness.charm.state.database_pool) == pool_databases
+
+    # pool is full, no more databases are created
+    harness.charm.on.update_status.emit()
+
+    assert fake_process.call_count(create_db_call) == 1
+
+
+def test_update_status_database_pool_refill_failed(harness, fake_process):
+    create_db_call = _mock_pg_databases_and_users_psql_call(
+        fake_process, {'juju_pool_aa11': 'Bb22'}, template='no_such_db', returncode=1
+    )
+    harness.update_config({'database_pool_size': 1, 'database_pool_template': 'no_such_db'})
+    harness.begin()
+    harness.charm.state.started = True
+
+    with mock.patch('charmtools.postgres._get_random_string', side_effect=['Aa11', 'Bb22', 'Bb22']):
+        harness.charm.on.update_status.emit()
+
+    assert fake_process.call_count(create_db_call) == 1
+    assert harness.charm.state.database_pool == {}
+    assert harness.charm.unit.status.name == 'blocked'
+
+
+def test_update_status_drops_pool_databases(harness, fake_process, random_string):
+    pool_database = 'juju_pool_aa11'
+    harness.update_config({'database_pool_size': 0})
+    harness.begin()
+    harness.charm.state.started = True
+    harness.charm.state.database_pool[pool_database] = json.dumps({'user': f'juju_{random_string}'})
+    drop_db_call = _register_query(fake_process, f'DROP DATABASE "{pool_database}"', returncode=1)
+
+    harness.charm.on.update_status.emit()
+
+    # pool database is kept in state until it's dropped
+    assert fake_process.call_count(drop_db_call) == 1
+    assert pool_database in harness.charm.state.database_pool
+
+    drop_db_call = _register_query(fake_process, f'DROP DATABASE "{pool_database}"')
+    drop_user_call = _register_query(fake_process, f'DROP USER "juju_{random_string}"')
+
+    harness.charm.on.update_status.emit()
+
+    assert fake_process.call_count(drop_user_call) == 1
+    assert harness.charm.state.database_pool == {}
+    assert harness.charm.unit.status.name == 'active'
+
+
+def test_db_relation_changed_claims_pool_database(
+    harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string, pg_main_dir
+):
+    database = db_rel_request['database']
+    pool_database = f'juju_pool_{random_string.lower()}'
+    harness.begin()
+    harness.charm.state.database_pool[pool_database] = json.dumps(
+        {
+            'host': pg_unit_ip,
+            'port': '5432',
+            'database': pool_database,
+            'user': f'juju_{random_string}',
+            'password': random_string,
+            'master': '',
+        }
+    )
+    rename_db_call = _register_query(fake_process, f'ALTER DATABASE "{pool_database}" RENAME TO "{database}"')
+    _register_reload(fake_process)
+
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    assert fake_process.call_count(rename_db_call) == 1
+    assert harness.charm.state.database_pool == {}
+    assert database in harness.charm.state.databases
+    rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
+    assert_db_relation_data(
+        rel_data, database, [unit.name], [db_rel_request['egress-subnets']], random_string, pg_unit_ip
+    )
+
+
+def test_db_relation_changed_claims_pool_database_create_failed(
+    harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string, pg_main_dir
+):
+    database, other_database = db_rel_request['database'], 'other_dev_db'
+    create_db_relation(harness, 'other', 'other/0', dict(db_rel_request, database=other_database))
+    pool_database = f'juju_pool_{random_string.lower()}'
+    harness.update_config({'database_pool_template': 'tpl_db'})
+    harness.begin()
+    harness.charm.state.database_pool[pool_database] = json.dumps(
+        {
+            'host': pg_unit_ip,
+            'port': '5432',
+            'database': pool_database,
+            'user': f'juju_{random_string}',
+            'password': random_string,
+            'master': '',
+        }
+    )
+    rename_db_call = _register_query(fake_process, f'ALTER DATABASE "{pool_database}" RENAME TO "{database}"')
+    # databases not served from the pool are created from the same template
+    create_db_call = _mock_pg_databases_and_users_psql_call(
+        fake_process, {other_database: random_string}, template='tpl_db', returncode=1
+    )
+    _register_reload(fake_process)
+
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    assert fake_process.call_count(rename_db_call) == 1
+    assert fake_process.call_count(create_db_call) == 1
+    # claimed pool database is kept although creating the other database failed
+    assert harness.charm.state.database_pool == {}
+    assert database in harness.charm.state.databases
+    assert other_database not in harness.charm.state.databases
+    assert harness.charm.unit.status.name == 'blocked'
+    rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
+    assert_db_relation_data(
+        rel_data, database, [unit.name], [db_rel_request['egress-subnets']], random_string, pg_unit_ip
+    )
+
+
+def test_db_relation_changed_existing_database_not_provisioned(harness, db_relation, app, unit, fake_process):
+    database = 'postgres'
+    harness.update_relation_data(db_relation.id, unit.name, {'database': database})
+    harness.begin()
+
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    # database not created by the charm is never handed out to db relation
+    assert database not in harness.charm.state.databases
+    rel_data = harness.model.get_relation(db_relation.name, db_relation.id).data[harness.model.unit]
+    assert dict(rel_data) == {}
+
+
+def test_db_relation_changed_create_database_failed(
+    harness, db_relation, app, unit, db_rel_request, fake_process, random_string, pg_databases
+):
+    database, other_database = db_rel_request['database'], 'other_dev_db'
+    other_relation = create_db_relation(harness, 'other', 'other/0', dict(db_rel_request, database=other_database))
+    # psql stops on the second CREATE DATABASE, first database is already committed
+    create_db_call = _mock_pg_databases_and_users_psql_call(
+        fake_process, {database: random_string, other_database: random_string}, returncode=1
+    )
+    drop_db_call = _register_query(fake_process, f'DROP DATABASE "{database}"')
+    existing_databases = pg_databases.return_value
+    pg_databases.side_effect = [existing_databases, existing_databases, existing_databases | {database}]
+    harness.begin()
+
+    other_unit = harness.model.get_unit('other/0')
+
+    with pytest.raises(subprocess.CalledProcessError):
+        harness.charm.on.db_relation_changed.emit(other_relation, other_unit.app, other_unit)
+
+    assert fake_process.call_count(create_db_call) == 1
+    # retrying provisioning doesn't fail on already existing database
+    assert fake_process.call_count(drop_db_call) == 1
+    assert harness.charm.state.databases == {}
 
 
 def test_db_relation_changed_unit_is_not_leader(harness, db_relation, app, unit):
@@ -164,10 +629,13 @@ def test_db_relation_changed_unit_is_not_leader(harness, db_relation, app, unit)
     assert dict(rel_data) == {}
 
 
-def test_db_relation_departed(harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string):
+def test_db_relation_departed(
+    harness, db_relation, app, unit, pg_unit_ip, db_rel_request, fake_process, random_string, pg_main_dir
+):
     database = db_rel_request['database']
     egress = db_rel_request['egress-subnets']
-    _mock_pg_database_and_user_psql_calls(fake_process, database, random_string)
+    _mock_pg_databases_and_users_psql_call(fake_process, {database: random_string})
+    _register_reload(fake_process)
     harness.begin()
 
     # create db relation first
@@ -181,30 +649,66 @@ def test_db_relation_departed(harness, db_relation, app, unit, pg_unit_ip, db_re
     relation.units.remove(unit)
     drop_db_call = _register_query(fake_process, f'DROP DATABASE "{database}"')
     drop_user_call = _register_query(fake_process, f'DROP USER "juju_{random_string}"')
+    _register_reload(fake_process)
     harness.charm.on.db_relation_departed.emit(relation, app, unit)
 
     assert database not in harness.charm.state.databases
     assert fake_process.call_count(drop_db_call) == 1
     assert fake_process.call_count(drop_user_call) == 1
+    # access rules of departed unit are removed
+    assert f'"{database}"' not in _read_content(pg_main_dir / 'pg_hba.conf')
 
 
-def _mock_pg_database_and_user_psql_calls(fake_process, database, random_string, port=5432):
-    return [
-        _register_query(fake_process, f'CREATE DATABASE "{database}"', port=str(port)),
-        _register_query(
-            fake_process,
-            f'CREATE USER "juju_{random_string}" WITH ENCRYPTED PASSWORD \'{random_string}\'',
-            port=str(port),
-        ),
-        _register_query(
-            fake_process, f'GRANT ALL PRIVILEGES ON DATABASE "{database}" TO "juju_{random_string}"', port=str(port)
-        ),
+def test_db_relation_changed_collapses_pg_hba_subnets(
+    harness, db_relation, app, unit, db_rel_request, fake_process, random_string, pg_main_dir
+):
+    database = db_rel_request['database']
+    _mock_pg_databases_and_users_psql_call(fake_process, {database: random_string})
+    reload_call = _register_reload(fake_process, occurrences=4)
+    harness.begin()
+
+    harness.charm.on.db_relation_changed.emit(db_relation, app, unit)
+
+    # adjacent and overlapping subnets of new units are merged with existing rules
+    subnets = ['10.216.12.87/32', '10.216.12.84/31', '10.216.12.85/32', '10.216.12.86/32,10.216.13.0/24']
+    for i, egress in enumerate(subnets, start=1):
+        app_unit = f'{app.name}/{i}'
+        harness.add_relation_unit(db_relation.id, app_unit)
+        harness.update_relation_data(db_relation.id, app_unit, dict(db_rel_request, **{'egress-subnets': egress}))
+        harness.charm.on.db_relation_changed.emit(db_relation, app, harness.model.get_unit(app_unit))
+
+    pg_hba_conf = _read_content(pg_main_dir / 'pg_hba.conf')
+    rules = [line for line in pg_hba_conf.splitlines() if line.startswith(f'host "{database}"')]
+    assert rules == [
+        f'host "{database}" "juju_{random_string}" 10.216.12.84/30 md5',
+        f'host "{database}" "juju_{random_string}" 10.216.13.0/24 md5',
     ]
+    # server is reloaded only when merged rules change
+    assert fake_process.call_count(reload_call) == 4
+
+
+def _mock_pg_databases_and_users_psql_call(fake_process, databases, port=5432, template=None, returncode=0):
+    users_query = '; '.join(
+        f'CREATE USER "juju_{random_string}" WITH ENCRYPTED PASSWORD \'{random_string}\'; '
+        f'GRANT ALL PRIVILEGES ON DATABASE "{database}" TO "juju_{random_string}"'
+        for database, random_string in databases.items()
+    )
+    template_clause = f' TEMPLATE "{template}"' if template else ''
+    create_queries = [f'CREATE DATABASE "{database}"{template_clause}' for database in databases]
+    return _register_query(fake_process, *create_queries, users_query, port=str(port), returncode=returncode)
+
+
+def _register_query(fake_process, *queries, stdout=None, port='5432', returncode=0):
+    cmd = ['sudo', '-u', 'postgres', 'psql', '-p', port, '-v', 'ON_ERROR_STOP=1']
+    for query in queries:
+        cmd.extend(['-c', f'{query}'])
+    fake_process.register_subprocess(cmd, stdout=stdout, returncode=returncode)
+    return cmd
 
 
-def _register_query(fake_process, query, stdout=None, port='5432'):
-    cmd = ['sudo', '-u', 'postgres', 'psql', '-p', port, '-c', f'{query}']
-    fake_process.register_subprocess(cmd, stdout=stdout)
+def _register_reload(fake_process, occurrences=1):
+    cmd = ['systemctl', 'reload', 'postgresql']
+    fake_process.register_subprocess(cmd, occurrences=occurrences)
     return cmd
 
 
@@ -0,0 +1,48 @@
+from charmtools import pgbench
+import pytest
+
+
+@pytest.mark.parametrize(
+    'tps_lines',
+    [
+        # PostgreSQL < 14
+        'tps = 1010.000000 (including connections establishing)\n'
+        'tps = 1234.567890 (excluding connections establishing)',
+        'tps = 1234.567890 (without initial connection time)',
+    ],
+)
+def test_parse_pgbench_output(tps_lines):
+    output = f"""transaction type: <builtin: TPC-B (sort of)>
+scaling factor: 10
+number of clients: 10
+number of threads: 2
+duration: 60 s
+number of transactions actually processed: 74074
+latency average = 8.100 ms
+{tps_lines}
+"""
+
+    assert pgbench.parse_pgbench_output(output) == {'tps': 1234.56789, 'latency_average_ms': 8.1}
+
+
+def test_parse_pgbench_output_unexpected():
+    with pytest.raises(ValueError):
+        pgbench.parse_pgbench_output('pgbench: fatal: connection to database "juju_pgbench" failed')
+
+
+def test_transaction_latencies_summary(tmp_path):
+    log_file = tmp_path / 'pgbench_log.1234'
+    lines = [f'0 {i} {(i + 1) * 1000} 0 1601971200 {i}' for i in range(100)]
+    lines.append('0 100 skipped 0 1601971200 100')
+    log_file.write_text('\n'.join(lines) + '\n')
+
+    summary = pgbench.summarize_latencies(pgbench.iter_transaction_latencies([log_file]))
+
+    assert summary == {'latency_p50_ms': 50.0, 'latency_p95_ms': 95.0, 'latency_p99_ms': 99.0}
+
+
+def test_compare_results():
+    result = {'scale': 10, 'tps': 1100.0, 'latency_average_ms': 9.0}
+    previous_result = {'scale': 10, 'tps': 1000.0, 'latency_average_ms': 10.0}
+
+    assert pgbench.compare_results(result, previous_result) == {'tps': 10.0, 'latency_average_ms': -10.0}
@@ -0,0 +1,65 @@
+import contextlib
+import subprocess
+from unittest import mock
+
+from charmtools import postgres
+import pytest
+
+PGBENCH_OUTPUT = b"""transaction type: <builtin: TPC-B (sort of)>
+latency average = 8.100 ms
+tps = 1234.567890 (excluding connections establishing)
+"""
+
+
+@pytest.fixture
+def pgbench_log_dir(tmp_path):
+    (tmp_path / 'pgbench_log.1234').write_text('0 0 4000 0 1601971200 0\n0 1 6000 0 1601971200 1\n')
+
+    @contextlib.contextmanager
+    def temporary_directory():
+        yield str(tmp_path)
+
+    with mock.patch('tempfile.TemporaryDirectory', temporary_directory), mock.patch('shutil.chown'):
+        yield tmp_path
+
+
+def test_run_pgbench(fake_process, pgbench_log_dir):
+    psql = ['sudo', '-u', 'postgres', 'psql', '-p', '5432', '-v', 'ON_ERROR_STOP=1', '-c']
+    pgbench = ['sudo', '-u', 'postgres', 'pgbench', '-p', '5432']
+    calls = [
+        psql + ['DROP DATABASE IF EXISTS "juju_pgbench"'],
+        psql + ['CREATE DATABASE "juju_pgbench"'],
+        pgbench + ['-i', '-q', '-s', '1', 'juju_pgbench'],
+        pgbench
+        + ['-c', '4', '-j', '2', '-T', '10', '-l', '--log-prefix', f'{pgbench_log_dir}/pgbench_log', 'juju_pgbench'],
+        psql + ['DROP DATABASE "juju_pgbench"'],
+    ]
+    for call in calls:
+        fake_process.register_subprocess(call, stdout=PGBENCH_OUTPUT if '-T' in call else None)
+
+    result = postgres.PGService().run_pgbench(scale=1, clients=4, threads=2, duration=10)
+
+    assert result == {
+        'tps': 1234.56789,
+        'latency_average_ms': 8.1,
+        'latency_p50_ms': 4.0,
+        'latency_p95_ms': 6.0,
+        'latency_p99_ms': 6.0,
+    }
+    assert [fake_process.call_count(call) for call in calls] == [1] * len(calls)
+
+
+def test_run_pgbench_drops_database_on_failure(fake_process, pgbench_log_dir):
+    psql = ['sudo', '-u', 'postgres', 'psql', '-p', '5432', '-v', 'ON_ERROR_STOP=1', '-c']
+    fake_process.register_subprocess(psql + ['DROP DATABASE IF EXISTS "juju_pgbench"'])
+    fake_process.register_subprocess(psql + ['CREATE DATABASE "juju_pgbench"'])
+    init_call = ['sudo', '-u', 'postgres', 'pgbench', '-p', '5432', '-i', '-q', '-s', '1', 'juju_pgbench']
+    fake_process.register_subprocess(init_call, returncode=1)
+    drop_call = psql + ['DROP DATABASE "juju_pgbench"']
+    fake_process.register_subprocess(drop_call)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        postgres.PGService().run_pgbench(scale=1, clients=4, threads=2, duration=10)
+
+    assert fake_process.call_count(init_call) == 1
+    assert fake_process.call_count(drop_call) == 1
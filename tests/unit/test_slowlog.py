@@ -0,0 +1,37 @@
+from charmtools import slowlog
+import pytest
+
+
+@pytest.mark.parametrize(
+    'statement, expected',
+    [
+        ("SELECT * FROM users WHERE name = 'O''Brien'", 'select * from users where name = ?'),
+        ('SELECT * FROM t WHERE id IN (1, 2, 3) LIMIT 10;', 'select * from t where id in (?) limit ?'),
+        ('UPDATE t\n   SET a = $1\n WHERE id = $2', 'update t set a = ? where id = ?'),
+        ('SELECT * FROM t2 WHERE x = 1.5', 'select * from t2 where x = ?'),
+    ],
+)
+def test_normalize_statement(statement, expected):
+    assert slowlog.normalize_statement(statement) == expected
+
+
+def test_summarize_slow_statements():
+    lines = [
+        f'2020-10-06 10:00:0{i}.000 UTC [1234] juju_x@db LOG:  duration: {duration} ms  statement: SELECT {i}\n'
+        for i, duration in enumerate(['1.000', '2.000', '3.000', '4.000'])
+    ]
+    lines.append(
+        '2020-10-06 10:00:09.000 UTC [1234] juju_x@db LOG:  duration: 5.000 ms  execute <unnamed>: SELECT $1\n'
+    )
+
+    since = slowlog.parse_timestamp('2020-10-06 10:00:01')
+    until = slowlog.parse_timestamp('2020-10-06 10:00:05')
+
+    [summary] = slowlog.summarize_slow_statements(lines, since, until)
+
+    assert summary['statement'] == 'select ?'
+    assert summary['count'] == 3
+    assert summary['total_ms'] == 9.0
+    assert summary['p50_ms'] == 3.0
+    assert summary['p99_ms'] == 4.0
+    assert summary['max_ms'] == 4.0
@@ -0,0 +1,16 @@
+from charmtools import tools
+
+
+def test_collapse_subnets():
+    subnets = [
+        '10.216.12.87/32',
+        '10.216.12.86/32',
+        '10.216.12.84/31',
+        '10.216.12.0/24',
+        '10.216.13.0/24',
+        '2001:db8::1/128',
+        '2001:db8::/128',
+        'juju-unit.lxd',
+    ]
+
+    assert tools.collapse_subnets(subnets) == ['10.216.12.0/23', '2001:db8::/127', 'juju-unit.lxd']
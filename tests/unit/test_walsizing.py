@@ -0,0 +1,49 @@
+from charmtools import walsizing
+
+MB = 1024 * 1024
+
+
+def test_recommend_settings_write_burst(previous_sample):
+    sample = dict(
+        previous_sample,
+        checkpoints_req=5.0,
+        maxwritten_clean=3.0,
+        wal_bytes=3000.0 * MB,
+        timestamp=previous_sample['timestamp'] + 300,
+    )
+
+    assert walsizing.recommend_settings(previous_sample, sample, 1024, 16384) == {
+        'max_wal_size': '8704MB',
+        'checkpoint_completion_target': '0.9',
+        'bgwriter_lru_maxpages': '200',
+    }
+
+
+def test_recommend_settings_limits(previous_sample):
+    timestamp = previous_sample['timestamp'] + 300
+    sample = dict(previous_sample, checkpoints_req=5.0, wal_bytes=30000.0 * MB, timestamp=timestamp)
+
+    assert walsizing.recommend_settings(previous_sample, sample, 1024, 4096)['max_wal_size'] == '4096MB'
+
+    quiet_sample = dict(previous_sample, max_wal_size=4096.0, wal_bytes=MB, timestamp=timestamp)
+
+    assert walsizing.recommend_settings(previous_sample, quiet_sample, 1024, 4096)['max_wal_size'] == '1024MB'
+
+
+def test_recommend_settings_small_change_keeps_max_wal_size(previous_sample):
+    sample = dict(previous_sample, wal_bytes=400.0 * MB, timestamp=previous_sample['timestamp'] + 300)
+
+    assert walsizing.recommend_settings(previous_sample, sample, 512, 4096)['max_wal_size'] == '1024MB'
+
+
+def test_recommend_settings_stats_reset(previous_sample):
+    sample = dict(previous_sample, checkpoints_timed=0.0, timestamp=previous_sample['timestamp'] + 300)
+
+    assert walsizing.recommend_settings(previous_sample, sample, 1024, 16384) == {}
+
+
+def test_get_changed_settings(previous_sample):
+    settings = {'max_wal_size': '1024MB', 'checkpoint_completion_target': '0.9', 'bgwriter_lru_maxpages': '100'}
+
+    assert walsizing.get_changed_settings(settings, previous_sample) == {'checkpoint_completion_target': '0.9'}
+    assert walsizing.get_changed_settings(settings, dict(previous_sample, checkpoint_completion_target=0.9)) == {}